@@ -0,0 +1,130 @@
+import functools
+import hashlib
+import os
+from typing import Dict, List, cast
+
+import numpy as np
+import torch
+from langchain_core.embeddings import Embeddings
+from sentence_transformers import SentenceTransformer
+from sentence_transformers.models import Transformer
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+# bf16 only pays off on CPUs with native support (AVX-512 BF16 / AMX), so opt-in
+CPU_BF16 = os.environ.get("LEARNDOCS_CPU_BF16") == "1"
+
+
+def pick_device() -> str:
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class BatchEmbeddings(Embeddings):
+    """SentenceTransformer embeddings encoded in large batches.
+
+    When given a cache path, vectors are memoized by the SHA256 of the text so
+    chunks repeated across pages (navigation, footers, snippets) are only
+    encoded once, including across runs once `save` has been called.
+
+    Cached vectors are held as float16, half the float32 size, both in memory
+    and on disk. Fresh and cached vectors alike are handed out from that
+    float16 copy, so a chunk gets the same vector whether it was a cache hit.
+    """
+
+    def __init__(
+        self,
+        model_name: str = MODEL_NAME,
+        batch_size: int = 256,
+        cache_path: str | None = None,
+        compile_model: bool = False,
+    ) -> None:
+        device = pick_device()
+        self.model = SentenceTransformer(model_name, device=device)
+        self.model.max_seq_length = 256
+        if device != "cpu":
+            self.model.half()
+        elif CPU_BF16:
+            self.model.to(torch.bfloat16)
+        self.batch_size = batch_size
+        self.compiled = False
+        if compile_model:
+            self.compile()
+        self.cache_path = cache_path
+        self.cache: Dict[str, np.ndarray] = {}
+        if cache_path and os.path.exists(cache_path):
+            with np.load(cache_path) as data:
+                vectors = data["vectors"]
+                # int8 caches from earlier versions are lossy, re-encode instead
+                if vectors.dtype != np.int8:
+                    vectors = vectors.astype(np.float16)
+                    self.cache = dict(zip(data["keys"].tolist(), vectors))
+
+    def compile(self) -> None:
+        """Specializes the transformer for one fixed input shape with torch.compile.
+
+        Inputs are padded to max_seq_length tokens and every call is padded to a
+        whole number of batch_size batches (see encode), so the compiled graph
+        only ever sees one shape. One full batch is run up front so the
+        compilation cost is paid before the crawl starts.
+        """
+
+        transformer = cast(Transformer, self.model[0])
+        # shadowing the bound tokenize method with an instance attribute is the
+        # point here, mypy flags it as a method reassignment
+        transformer.tokenize = functools.partial(  # type: ignore[method-assign]
+            transformer.tokenize, padding="max_length"
+        )
+        transformer.auto_model = torch.compile(
+            transformer.auto_model,
+            mode="reduce-overhead",
+            fullgraph=True,
+            dynamic=False,
+        )
+        self.compiled = True
+        self.encode(["warmup"])
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        n = len(texts)
+        if self.compiled:
+            # a partial batch would be a new shape and trigger a recompile
+            texts = texts + [""] * (-n % self.batch_size)
+        vectors = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+        return vectors[:n].astype(np.float32, copy=False)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(t) for t in texts]
+        misses: Dict[str, str] = {}
+        for h, text in zip(hashes, texts):
+            if h not in self.cache:
+                misses[h] = text
+        if misses:
+            vectors = self.encode(list(misses.values())).astype(np.float16)
+            self.cache.update(zip(misses.keys(), vectors))
+        embedded: List[List[float]] = np.stack([self.cache[h] for h in hashes]).tolist()
+        return embedded
+
+    def embed_query(self, text: str) -> List[float]:
+        vector: List[float] = self.encode([text])[0].tolist()
+        return vector
+
+    def save(self) -> None:
+        if not self.cache_path or not self.cache:
+            return
+        np.savez_compressed(
+            self.cache_path,
+            keys=np.array(list(self.cache.keys())),
+            vectors=np.stack(list(self.cache.values())),
+        )
@@ -1,28 +1,60 @@
-import hashlib
+import asyncio
+import gzip
+import json
 import os
+import pickle
+import queue
+import re
 import time
-from typing import List, Set, TypedDict
-from urllib.parse import urljoin
-
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
+from urllib.parse import urljoin, urlsplit
+
+import aiofiles
+import aiohttp
+import chromadb
+import numpy as np
 import typer
-from bs4 import BeautifulSoup
+from blake3 import blake3
+from bs4 import BeautifulSoup, Tag
+from bs4.element import NavigableString, PageElement
+from bs4.filter import SoupStrainer
 from chromadb import Metadata
-from langchain_experimental.text_splitter import SemanticChunker
-from langchain_huggingface import HuggingFaceEmbeddings
-from markdownify import markdownify as md
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-from vectordb import add_data, create_collection
+from embedder import BatchEmbeddings
+from vectordb import VectorBuffer, create_collection, tune_for_query
 
 app = typer.Typer()
 
-
-class LinkInfo(TypedDict):
-    link: str
-    depth: int
+# (id, document, metadata) of every chunk of a page
+Chunks = List[Tuple[str, str, Metadata]]
+# ids, documents, metadatas and vectors of a batch ready to upsert
+Embedded = Tuple[List[str], List[str], List[Metadata], List[List[float]]]
 
 
 CLEAR_LINE = "\x1b[2K"
+# politeness: at most this many in-flight downloads per host, each followed by a pause
+HOST_CONCURRENCY = 2
+HOST_DELAY = 2
+REQUEST_TIMEOUT = 10
+RETRIES = 3
+RETRY_BACKOFF = 0.5
+USER_AGENT = "learndocs/1.0"
+# maximum number of chunks encoded by the model in one call
+EMBED_BATCH = 256
+# seconds the compiled model waits for EMBED_BATCH chunks before encoding fewer
+COMPILED_BATCH_WAIT = 2.0
+# number of chunks written to chroma per upsert
+UPSERT_BATCH = 1000
+SKIP_HREF = re.compile(r"/cdn-cgi|#")
+CONTENT_TAGS = SoupStrainer(
+    ["a", "title", "main", "article", "h1", "h2", "h3", "p", "code", "pre"]
+)
+# chrome that can still be nested inside <main>/<article>
+SKIP_TAGS = {"title", "nav", "footer", "header", "aside", "script", "style", "svg"}
+BLOCK_TAGS = {"div", "section", "ul", "ol", "table", "blockquote", "br"}
+WHITESPACE = re.compile(r"\s+")
 
 
 def create_folder(name: str) -> None:
@@ -33,21 +65,25 @@ def create_folder(name: str) -> None:
         print(f"-> Folder {name} already exists")
 
 
-def write_cache(project: str, name: str, txt: str) -> None:
-    file_name = os.path.join("cache", project, f"{name}.txt")
+async def write_cache(project: str, name: str, data: bytes) -> None:
+    file_name = os.path.join("cache", project, f"{name}.gz")
+    loop = asyncio.get_running_loop()
     try:
-        with open(file_name, "w") as file:
-            file.write(txt)
+        compressed = await loop.run_in_executor(None, gzip.compress, data, 3)
+        async with aiofiles.open(file_name, "wb") as file:
+            await file.write(compressed)
     except Exception as e:
         print("Error while writing to the file: ")
         print(e)
 
 
-def get_cache(project: str, name: str) -> str | None:
-    file_name = os.path.join("cache", project, f"{name}.txt")
+async def get_cache(project: str, name: str) -> bytes | None:
+    file_name = os.path.join("cache", project, f"{name}.gz")
+    loop = asyncio.get_running_loop()
     try:
-        with open(file_name, "r") as file:
-            return file.read()
+        async with aiofiles.open(file_name, "rb") as file:
+            compressed = await file.read()
+        return await loop.run_in_executor(None, gzip.decompress, compressed)
     except Exception:
         return None
 
@@ -56,144 +92,444 @@ def check_cache(project: str, name: str | None) -> bool:
     if not name:
         file_name = os.path.join("cache", project)
         return os.path.exists(file_name)
-    file_name = os.path.join("cache", project, f"{name}.txt")
+    file_name = os.path.join("cache", project, f"{name}.gz")
     return os.path.exists(file_name)
 
 
+def get_query_cache(project: str) -> Dict[str, List[float]]:
+    file_name = os.path.join("cache", project, "qcache.pkl")
+    try:
+        with open(file_name, "rb") as file:
+            return dict(pickle.load(file))
+    except Exception:
+        return {}
+
+
+def write_query_cache(project: str, qcache: Dict[str, List[float]]) -> None:
+    file_name = os.path.join("cache", project, "qcache.pkl")
+    try:
+        with open(file_name, "wb") as file:
+            pickle.dump(qcache, file)
+    except Exception as e:
+        print("Error while writing to the file: ")
+        print(e)
+
+
 def url_to_filename(url: str) -> str:
-    """Creates a safe and unique filename from a URL using SHA256 hashing."""
+    """Creates a safe and unique filename from a URL using BLAKE3 hashing."""
 
-    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return blake3(url.encode("utf-8")).hexdigest(16)
 
 
-@app.command()
-def fetch(
+def url_key(url: str) -> bytes:
+    """Compact fixed-size key for the visited set (16 bytes instead of the URL)."""
+
+    return blake3(url.encode("utf-8")).digest(16)
+
+
+async def get_validators(project: str, name: str) -> Dict[str, str]:
+    file_name = os.path.join("cache", project, f"{name}.json")
+    try:
+        async with aiofiles.open(file_name, "r") as file:
+            return dict(json.loads(await file.read()))
+    except Exception:
+        return {}
+
+
+async def write_validators(project: str, name: str, validators: Dict[str, str]) -> None:
+    file_name = os.path.join("cache", project, f"{name}.json")
+    try:
+        async with aiofiles.open(file_name, "w") as file:
+            await file.write(json.dumps(validators))
+    except Exception as e:
+        print("Error while writing to the file: ")
+        print(e)
+
+
+async def download(
+    session: aiohttp.ClientSession, url: str, headers: Dict[str, str]
+) -> Tuple[int, bytes, Dict[str, str]]:
+    """GETs url, retrying connection errors and 5xx responses with backoff."""
+
+    attempt = 0
+    while True:
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    return 304, b"", {}
+                response.raise_for_status()
+                validators = {
+                    name: response.headers[name]
+                    for name in ("ETag", "Last-Modified")
+                    if name in response.headers
+                }
+                return response.status, await response.read(), validators
+        except aiohttp.ClientResponseError as e:
+            if e.status < 500 or attempt == RETRIES - 1:
+                raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == RETRIES - 1:
+                raise
+        await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+        attempt = attempt + 1
+
+
+async def fetch_one(
+    session: aiohttp.ClientSession,
+    host_limits: Dict[str, asyncio.Semaphore],
     project: str,
+    url: str,
+    force_recache: bool,
+) -> Tuple[str, bytes | None]:
+    filename = url_to_filename(url)
+    loop = asyncio.get_running_loop()
+    cached = None
+    if await loop.run_in_executor(None, check_cache, project, filename):
+        cached = await get_cache(project, filename)
+    if cached and not force_recache:
+        print(f"{CLEAR_LINE}{url} found in cache.", end="\r")
+        return url, cached
+
+    # when recaching, revalidate instead of downloading unchanged pages again
+    headers: Dict[str, str] = {}
+    if cached:
+        validators = await get_validators(project, filename)
+        if "ETag" in validators:
+            headers["If-None-Match"] = validators["ETag"]
+        if "Last-Modified" in validators:
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+
+    host = urlsplit(url).netloc
+    limit = host_limits.setdefault(host, asyncio.Semaphore(HOST_CONCURRENCY))
+    async with limit:
+        try:
+            print(f"{CLEAR_LINE} {url} Not in cache. Downloading...", end="\r")
+            status, html_content, validators = await download(session, url, headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"{CLEAR_LINE}Error while trying to fetch {url}", end="\r")
+            print(f"{e}")
+            return url, None
+        finally:
+            await asyncio.sleep(HOST_DELAY)
+    if status == 304 and cached:
+        print(f"{CLEAR_LINE}{url} not modified, using cache.", end="\r")
+        return url, cached
+    await write_cache(project, filename, html_content)
+    if validators:
+        await write_validators(project, filename, validators)
+    return url, html_content
+
+
+def tree_to_md(node: Tag, out: List[str]) -> None:
+    """Appends the markdown for the children of node to out."""
+
+    for child in node.children:
+        node_to_md(child, out)
+
+
+def node_to_md(child: PageElement, out: List[str]) -> None:
+    """Appends the markdown for a single node to out."""
+
+    if isinstance(child, NavigableString):
+        if type(child) is NavigableString:
+            out.append(WHITESPACE.sub(" ", child))
+        return
+    if not isinstance(child, Tag) or child.name in SKIP_TAGS:
+        return
+    name = child.name
+    if len(name) == 2 and name[0] == "h" and name[1] in "123456":
+        text = WHITESPACE.sub(" ", child.get_text()).strip()
+        out.append(f"\n\n{'#' * int(name[1])} {text}\n\n")
+    elif name == "pre":
+        out.append(f"\n\n```\n{child.get_text().strip()}\n```\n\n")
+    elif name == "code":
+        out.append(f"`{child.get_text()}`")
+    elif name == "a":
+        text = WHITESPACE.sub(" ", child.get_text()).strip()
+        href = child.get("href")
+        out.append(f"[{text}]({href})" if href and text else text)
+    elif name == "p":
+        out.append("\n\n")
+        tree_to_md(child, out)
+        out.append("\n\n")
+    elif name == "li":
+        out.append("\n- ")
+        tree_to_md(child, out)
+    elif name == "tr":
+        cells = child.find_all(["td", "th"], recursive=False)
+        row = [WHITESPACE.sub(" ", cell.get_text()).strip() for cell in cells]
+        out.append(f"\n| {' | '.join(row)} |")
+        if cells and all(cell.name == "th" for cell in cells):
+            out.append(f"\n|{' --- |' * len(cells)}")
+    elif name in BLOCK_TAGS:
+        out.append("\n")
+        tree_to_md(child, out)
+        out.append("\n")
+    else:
+        tree_to_md(child, out)
+
+
+def parse_page(original: str, html_content: bytes) -> Tuple[str, str, List[str]]:
+    """Returns the title, markdown and same-site links of a page."""
+
+    # only materialize the tags that carry content or links, everything else
+    # (scripts, styles, svgs, images) is never built at all
+    soup = BeautifulSoup(html_content, "lxml", parse_only=CONTENT_TAGS)
+    title = str(soup.title)
+    # the strainer also keeps the links, paragraphs and headings of header,
+    # nav, footer and aside as top-level nodes: those are needed for crawling
+    # but only the main content goes into the markdown
+    parts: List[str] = []
+    roots = soup.find_all(["main", "article"], recursive=False)
+    for root in roots:
+        tree_to_md(root, parts)
+    if not roots:
+        # top-level nodes are unrelated fragments (often bare links), keep
+        # them on separate lines
+        for child in soup.children:
+            node_to_md(child, parts)
+            parts.append("\n")
+    llm_md = re.sub(r"\n\s*\n", "\n\n", "".join(parts)).strip()
+
+    base = urlsplit(original)
+    found: List[str] = []
+    for link in soup.find_all("a", href=True):
+        href = str(link["href"])
+        if SKIP_HREF.search(href):
+            continue
+        complete_url = urljoin(original, href)
+        split = urlsplit(complete_url)
+        if split.netloc == base.netloc and split.path.startswith(base.path):
+            found.append(complete_url)
+    return title, llm_md, found
+
+
+def parse_and_chunk(
+    text_splitter: RecursiveCharacterTextSplitter,
+    embed_q: queue.Queue[Chunks | None],
     original: str,
-    force_recache: bool = typer.Option(
-        False, "--force-recache", "-f", help="Recache even if already exists"
-    ),
-):
-    start = time.time()
-    if not project:
-        print("Name is required")
-        raise typer.Exit()
-    if not original:
-        print("Original is required")
-        raise typer.Exit()
+    current_url: str,
+    html_content: bytes,
+    n: int,
+) -> List[str]:
+    """Parses and chunks a page for the embed stage, returning its links."""
+
+    title, llm_md, found = parse_page(original, html_content)
+    chunks: Chunks = []
+    for i, line in enumerate(text_splitter.create_documents([llm_md])):
+        chunk_id = f"url_crawler_{title}_{n}_{i}"
+        chunks.append(
+            (
+                chunk_id,
+                line.page_content,
+                {"source_url": current_url, "title": title, "id": chunk_id},
+            )
+        )
+    if chunks:
+        embed_q.put(chunks)
+    return found
+
+
+def embed_worker(
+    embeddings: BatchEmbeddings,
+    embed_q: queue.Queue[Chunks | None],
+    upsert_q: queue.Queue[Embedded | None],
+) -> None:
+    """Owns the model: encodes up to EMBED_BATCH queued chunks per call.
 
+    A compiled model always runs full padded batches, so it waits up to
+    COMPILED_BATCH_WAIT seconds for a batch to fill instead of encoding
+    whatever happens to be queued.
+    """
+
+    wait = COMPILED_BATCH_WAIT if embeddings.compiled else 0.0
+    done = False
+    try:
+        while not done:
+            batch: Chunks = []
+            item = embed_q.get()
+            deadline = time.monotonic() + wait
+            while item is not None:
+                batch.extend(item)
+                if len(batch) >= EMBED_BATCH:
+                    break
+                try:
+                    remaining = deadline - time.monotonic()
+                    if remaining > 0:
+                        item = embed_q.get(timeout=remaining)
+                    else:
+                        item = embed_q.get_nowait()
+                except queue.Empty:
+                    break
+            done = item is None
+            if batch:
+                ids = [chunk[0] for chunk in batch]
+                documents = [chunk[1] for chunk in batch]
+                metadatas = [chunk[2] for chunk in batch]
+                vectors = embeddings.embed_documents(documents)
+                upsert_q.put((ids, documents, metadatas, vectors))
+    finally:
+        # always release the writer, even if encoding failed
+        upsert_q.put(None)
+
+
+def upsert_worker(
+    collection: chromadb.Collection, upsert_q: queue.Queue[Embedded | None]
+) -> None:
+    """Owns the chroma writes: buffers embedded chunks and upserts in bulk."""
+
+    buffer = VectorBuffer()
+    while (item := upsert_q.get()) is not None:
+        ids, documents, metadatas, vectors = item
+        buffer.extend(documents, ids, metadatas, vectors)
+        if len(buffer) >= UPSERT_BATCH:
+            buffer.flush(collection, UPSERT_BATCH)
+    buffer.flush(collection, UPSERT_BATCH)
+
+
+async def fetch_async(
+    project: str, original: str, force_recache: bool, compile_model: bool
+) -> None:
+    start = time.time()
     print("Setting up cache folders")
     create_folder("cache")
     create_folder(os.path.join("cache", project))
     print("Setting up the required environment")
-    links: List[LinkInfo] = [{"link": original, "depth": 0}]
-    visited = set([original])
+    wave: List[str] = [original]
+    visited: Set[bytes] = set([url_key(original)])
     links_not_downloaded: Set[str] = set()
     max_links = 10
     max_depth = 1
+    depth = 0
     n = 0
     collection = create_collection(project)
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-    text_splitter = SemanticChunker(embeddings=embeddings)
-    while n < max_links and n < len(links):
-        current = links[n]
-        current_url = current["link"]
-        current_depth = current["depth"]
-        if current_depth < max_depth:
-            n = n + 1
-        else:
-            print("\n")
-            print(5 * "-", "Exceeded Maximum Depth: Stopping the service", 5 * "-")
-            print(f"Processed {len(visited)} unique pages.")
-            if len(links_not_downloaded) > 0:
-                print(f"{len(links_not_downloaded)} links not downloaded/processed")
-            raise typer.Exit()
-
-        filename = url_to_filename(current_url)
-        print(
-            f"{CLEAR_LINE}Processing: {current_url} (Depth: {current_depth})", end="\r"
-        )
-        html_content = None
-
-        if not force_recache and check_cache(project, filename):
-            html_content = get_cache(project, filename)
+    embeddings = BatchEmbeddings(
+        cache_path=os.path.join("cache", project, "embed_cache.npz"),
+        compile_model=compile_model,
+    )
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=800,
+        chunk_overlap=100,
+        separators=["\n## ", "\n### ", "\n\n", "\n", ". ", " "],
+    )
+    loop = asyncio.get_running_loop()
+    host_limits: Dict[str, asyncio.Semaphore] = {}
+
+    # download (event loop) -> parse and chunk (thread pool) -> embed (one
+    # thread holding the model) -> upsert (one thread holding chroma), so the
+    # network, CPU, model and disk work of different pages overlap
+    embed_q: queue.Queue[Chunks | None] = queue.Queue()
+    upsert_q: queue.Queue[Embedded | None] = queue.Queue()
+    # futures rather than bare threads, so a failing stage fails the command
+    stage_pool = ThreadPoolExecutor(max_workers=2)
+    embedding = loop.run_in_executor(
+        stage_pool, embed_worker, embeddings, embed_q, upsert_q
+    )
+    writing = loop.run_in_executor(stage_pool, upsert_worker, collection, upsert_q)
+    parse_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
 
+    async def process(url: str, n: int) -> List[str] | None:
+        current_url, html_content = await fetch_one(
+            session, host_limits, project, url, force_recache
+        )
         if not html_content:
-            try:
-                print(
-                    f"{CLEAR_LINE} {current_url} Not in cache. Downloading...", end="\r"
-                )
-                response = requests.get(current_url)
-                response.raise_for_status()
-                html_content = response.text
-                time.sleep(2)
-            except requests.RequestException as e:
-                links_not_downloaded.add(current_url)
+            links_not_downloaded.add(current_url)
+            print(f"No HTML Content {current_url}", end="\r")
+            return None
+        return await loop.run_in_executor(
+            parse_pool,
+            parse_and_chunk,
+            text_splitter,
+            embed_q,
+            original,
+            current_url,
+            html_content,
+            n,
+        )
+
+    connector = aiohttp.TCPConnector(limit_per_host=4, limit=64)
+    try:
+        async with aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            headers={"User-Agent": USER_AGENT},
+        ) as session:
+            # breadth first: every page of a depth level is downloaded concurrently
+            while wave and n < max_links:
+                if depth >= max_depth:
+                    print("\n")
+                    print(
+                        5 * "-",
+                        "Exceeded Maximum Depth: Stopping the service",
+                        5 * "-",
+                    )
+                    break
+                wave = wave[: max_links - n]
                 print(
-                    f"{CLEAR_LINE}Error while trying to fetch {current_url}", end="\r"
-                )
-                print(f"{e}")
-        else:
-            print(f"{CLEAR_LINE}{current_url} found in cache.", end="\r")
-        if html_content:
-            soup = BeautifulSoup(html_content, "html.parser")
-
-            # remove unnecessary tags keeping the content of the page clean
-            for tag in [
-                "nav",
-                "footer",
-                "header",
-                "aside",
-                "script",
-                "style",
-                "svg",
-                "img",
-            ]:
-                for element in soup.find_all(tag):
-                    element.decompose()
-            write_cache(project, filename, str(soup))
-            title = str(soup.title)
-            llm_md = md(str(soup))
-
-            docs = text_splitter.create_documents([llm_md])
-            metadatas: List[Metadata] = []
-            documents: List[str] = []
-            ids: List[str] = []
-            for i, line in enumerate(docs):
-                metadatas.append(
-                    {
-                        "source_url": current_url,
-                        "title": title,
-                        "id": f"url_crawler_{title}_{n}_{i}",
-                    }
+                    f"{CLEAR_LINE}Processing {len(wave)} pages (Depth: {depth})",
+                    end="\r",
                 )
-                documents.append(line.page_content)
-                ids.append(f"url_crawler_{title}_{n}_{i}")
-            add_data(collection, documents=documents, ids=ids, metadatas=metadatas)
-            all_links = soup.find_all("a")
-
-            for link in all_links:
-                href = link.get("href")
-                if href:
-                    if "/cdn-cgi" in href:
-                        continue
-                    if "#" in href:
-                        continue
-                    complete_url = urljoin(original, str(href))
-                    if original in complete_url and complete_url not in visited:
-                        new_link: LinkInfo = {
-                            "link": complete_url,
-                            "depth": current_depth + 1,
-                        }
-                        visited.add(complete_url)
-                        links.append(new_link)
-        else:
-            print(f"No HTML Content {current_url}", end="\r")
+                # a TaskGroup cancels and awaits the rest of the wave if one
+                # page fails, so nothing is still running during teardown
+                async with asyncio.TaskGroup() as wave_tasks:
+                    tasks = [
+                        wave_tasks.create_task(process(url, n + i + 1))
+                        for i, url in enumerate(wave)
+                    ]
+                results = [task.result() for task in tasks]
+                n = n + len(wave)
+                # dedupe the whole wave's links with one set difference and
+                # one union instead of a lookup and add per anchor
+                candidates = {
+                    url_key(complete_url): complete_url
+                    for found in results
+                    for complete_url in found or []
+                }
+                new = candidates.keys() - visited
+                visited |= new
+                wave = [url for key, url in candidates.items() if key in new]
+                depth = depth + 1
+    finally:
+        # waits for parse jobs already handed to the pool, so their chunks are
+        # queued ahead of the sentinel
+        await asyncio.to_thread(parse_pool.shutdown)
+        embed_q.put(None)
+        stages = await asyncio.gather(embedding, writing, return_exceptions=True)
+        stage_pool.shutdown()
+        # keep everything encoded so far, even when the crawl failed midway
+        embeddings.save()
+        for stage in stages:
+            if isinstance(stage, BaseException):
+                raise stage
     end = time.time()
     print("\n--- Crawl Complete ---")
     print(
         f"Processed {len(visited)} unique pages. It took {end - start} seconds to complete."
     )
+    if len(links_not_downloaded) > 0:
+        print(f"{len(links_not_downloaded)} links not downloaded/processed")
+
+
+@app.command()
+def fetch(
+    project: str,
+    original: str,
+    force_recache: bool = typer.Option(
+        False, "--force-recache", "-f", help="Recache even if already exists"
+    ),
+    compile_model: bool = typer.Option(
+        False,
+        "--compile",
+        help="Compile the embedding model with torch.compile (slower startup)",
+    ),
+):
+    if not project:
+        print("Name is required")
+        raise typer.Exit()
+    if not original:
+        print("Original is required")
+        raise typer.Exit()
+    asyncio.run(fetch_async(project, original, force_recache, compile_model))
 
 
 @app.command()
@@ -206,6 +542,7 @@ def ask(
         "-f",
         help="Force use this question instead of using LLM generated ones",
     ),
+    k: int = typer.Option(2, "--results", "-k", help="Number of chunks to return"),
 ):
     if not project:
         print("Project name is required")
@@ -215,7 +552,18 @@ def ask(
         raise typer.Exit()
     print(f"Processing your question for {project} project")
     collection = create_collection(project)
-    results = collection.query(query_texts=[question], n_results=2)
+    tune_for_query(collection)
+    # embed with the ingest model (not chroma's default) and remember the vector
+    qcache = get_query_cache(project)
+    qhash = blake3(question.encode("utf-8")).hexdigest()
+    qvec = qcache.get(qhash)
+    if qvec is None:
+        qvec = BatchEmbeddings().embed_query(question)
+        qcache[qhash] = qvec
+        write_query_cache(project, qcache)
+    results = collection.query(
+        query_embeddings=np.asarray([qvec], dtype=np.float32), n_results=k
+    )
     print(results)
 
 
@@ -1,22 +1,81 @@
 import chromadb
-from typing import List
+import numpy as np
+import os
+from chromadb.api import ClientAPI
+from dataclasses import dataclass, field
+from typing import Dict, List
 
+# HNSW build parameters, kept cheap for bulk ingest
+HNSW_EF_CONSTRUCTION = int(os.environ.get("LEARNDOCS_HNSW_EF_CONSTRUCTION", 100))
+HNSW_M = int(os.environ.get("LEARNDOCS_HNSW_M", 16))
+HNSW_BATCH_SIZE = int(os.environ.get("LEARNDOCS_HNSW_BATCH_SIZE", 1000))
+HNSW_SYNC_THRESHOLD = int(os.environ.get("LEARNDOCS_HNSW_SYNC_THRESHOLD", 10000))
+# raised at query time to get the recall back
+HNSW_EF_SEARCH = int(os.environ.get("LEARNDOCS_HNSW_EF_SEARCH", 128))
 
+# when set, talk to a long-lived chroma server instead of an embedded database
+CHROMA_HOST = os.environ.get("LEARNDOCS_CHROMA_HOST")
+CHROMA_PORT = int(os.environ.get("LEARNDOCS_CHROMA_PORT", 8000))
 
+_clients: Dict[str, ClientAPI] = {}
 
-def create_collection(name:str):
-    client = chromadb.PersistentClient(path=f"chroma/{name}")
-    return client.get_or_create_collection(name=name)
 
-def add_data(c:chromadb.Collection, documents: List[str], ids: List[str],metadatas:List[chromadb.Metadata]):
-    c.upsert(
-    documents=documents,
-    ids=ids,
-    metadatas=metadatas
-)
+def get_client(path:str) -> ClientAPI:
+    if CHROMA_HOST:
+        path = f"http://{CHROMA_HOST}:{CHROMA_PORT}"
+    if path not in _clients:
+        if CHROMA_HOST:
+            _clients[path] = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+        else:
+            _clients[path] = chromadb.PersistentClient(path=path)
+    return _clients[path]
 
-def get_result(c:chromadb.Collection, query:str, k:int = 2):
-    return c.query(
-    query_texts=query,
-    n_results=k
+def create_collection(name:str) -> chromadb.Collection:
+    client = get_client(f"chroma/{name}")
+    return client.get_or_create_collection(
+    name=name,
+    configuration={
+        "hnsw": {
+            "space": "cosine",
+            "ef_construction": HNSW_EF_CONSTRUCTION,
+            "max_neighbors": HNSW_M,
+            "batch_size": HNSW_BATCH_SIZE,
+            "sync_threshold": HNSW_SYNC_THRESHOLD,
+        }
+    }
 )
+
+def tune_for_query(c:chromadb.Collection) -> None:
+    # modify is a persistent write, only issue it when the value differs
+    hnsw = c.configuration.get("hnsw") or {}
+    if hnsw.get("ef_search") != HNSW_EF_SEARCH:
+        c.modify(configuration={"hnsw": {"ef_search": HNSW_EF_SEARCH}})
+
+@dataclass
+class VectorBuffer:
+    documents: List[str] = field(default_factory=list)
+    ids: List[str] = field(default_factory=list)
+    metadatas: List[chromadb.Metadata] = field(default_factory=list)
+    embeddings: List[List[float]] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def extend(self, documents: List[str], ids: List[str], metadatas: List[chromadb.Metadata], embeddings: List[List[float]]) -> None:
+        self.documents.extend(documents)
+        self.ids.extend(ids)
+        self.metadatas.extend(metadatas)
+        self.embeddings.extend(embeddings)
+
+    def flush(self, c:chromadb.Collection, batch: int = 1000) -> None:
+        for i in range(0, len(self), batch):
+            c.upsert(
+            documents=self.documents[i:i + batch],
+            ids=self.ids[i:i + batch],
+            metadatas=self.metadatas[i:i + batch],
+            embeddings=np.asarray(self.embeddings[i:i + batch], dtype=np.float32)
+        )
+        self.documents.clear()
+        self.ids.clear()
+        self.metadatas.clear()
+        self.embeddings.clear()